@@ -1,13 +1,25 @@
-from ctypes import WinError, resize, sizeof
+"""Implementation of :func:`select.poll` on Microsoft Windows, via ``WSAPoll``.
+
+Set the ``WINPOLL_DEBUG_CHECK`` environment variable (to any non-empty value)
+to run internal consistency assertions after every registration change; they
+are skipped by default. Additionally set ``WINPOLL_FULLCHECK`` to have those
+assertions verify every slot (O(N) per mutation) rather than just the O(1)
+invariants. Both are ignored under ``python -O``.
+"""
+
+from ctypes import WINFUNCTYPE, WinError, byref, memmove, resize, sizeof
 from ctypes import windll
 from ctypes.wintypes import INT, LPVOID, ULONG
 from errno import ENOENT
 import logging
+import os
 from selectors import _PollLikeSelector
 from socket import SOCK_STREAM, socket as socket_
+from struct import Struct
 import sys
 from threading import Lock
 from time import monotonic_ns  # Python 3.7+
+from weakref import WeakKeyDictionary
 
 from ._util.select_extra import *
 from ._util import (
@@ -41,24 +53,77 @@ __all__ = [
 IS_PRE_19041 = sys.getwindowsversion() < (10, 0, 19041)
 _POLL_DISCONNECTION = POLLHUP | POLLERR | POLLWRNORM
 
+# see the module docstring; evaluated once, so the per-mutation cost of an
+# unset flag is a single LOAD_GLOBAL rather than an environment lookup
+_DEBUG_CHECK = __debug__ and bool(os.environ.get('WINPOLL_DEBUG_CHECK'))
+_FULL_CHECK = _DEBUG_CHECK and bool(os.environ.get('WINPOLL_FULLCHECK'))
 
-_WSAPoll = windll.Ws2_32['WSAPoll']
+# Round buffer growth up to the allocation granularity (typically 64 KiB)
+# only once the buffer is big enough for the alignment to pay off; below
+# this, plain doubling wastes far less memory on small pollsets.
+_GROWTH_ALIGN_THRESHOLD = 4096
 
-_WSAPoll.argtypes = [
-    LPVOID,
-    ULONG,
-    INT,
-]
 
+# Bound through an explicit WINFUNCTYPE prototype so the calling convention,
+# signature, and GIL behavior are all stated in one place: foreign calls made
+# this way release the GIL for the duration of WSAPoll's wait (only PyDLL
+# holds it), letting other threads run while we block.
+_WSAPoll = WINFUNCTYPE(INT, LPVOID, ULONG, INT)(('WSAPoll', windll.Ws2_32))
+
+_WSAGetLastError = WINFUNCTYPE(INT)(('WSAGetLastError', windll.Ws2_32))
+
+
+def _wsapollfd_struct():
+    # WSAPOLLFD as a struct format, so _poll can walk the raw buffer in a
+    # single C-level loop instead of materializing a ctypes proxy (and three
+    # descriptor calls) per slot. The format is built from the field offsets
+    # ctypes actually chose -- "=" mode plus explicit "x" padding -- rather
+    # than trusting struct's own alignment rules to agree with the ABI.
+    unsigned = {1: 'B', 2: 'H', 4: 'L', 8: 'Q'}
+    signed = {1: 'b', 2: 'h', 4: 'l', 8: 'q'}
+
+    fmt = '='
+    pos = 0
+    for field, codes in (
+        (WSAPOLLFD.fd, unsigned),
+        (WSAPOLLFD.events, signed),
+        (WSAPOLLFD.revents, signed),
+    ):
+        if field.offset > pos:
+            fmt += f"{field.offset - pos}x"
+        fmt += codes[field.size]
+        pos = field.offset + field.size
+
+    # trailing padding, so the record size matches the array stride
+    if sizeof(WSAPOLLFD) > pos:
+        fmt += f"{sizeof(WSAPOLLFD) - pos}x"
+
+    return Struct(fmt)
 
-_WSAGetLastError = windll.Ws2_32['WSAGetLastError']
+_WSAPOLLFD_STRUCT = _wsapollfd_struct()
+assert _WSAPOLLFD_STRUCT.size == sizeof(WSAPOLLFD)
 
 
 class wsapoll:
     __slots__ = [
-        '_registered',
+        # fd -> index into impl, so register/modify/unregister are O(1)
+        # instead of scanning every slot (each scan step being a full
+        # ctypes descriptor call).
+        '__fd_to_idx',
         '__impl',
-        '__impl_uptodate',
+        # count of registrations watching exactly _POLL_DISCONNECTION,
+        # maintained incrementally (and only on pre-19041 Windows) so poll()
+        # never has to scan the slots for the diagnostic below
+        '__n_maybe_affected',
+        # opportunistic fileobj -> fd cache, so repeat calls with the same
+        # object skip the fileno() virtual call; weakly keyed, so entries
+        # vanish with their objects
+        '__obj_to_fd',
+        # fd -> sticky eventmask for registrations made with oneshot=True;
+        # fired events are cleared from slot.events after each poll, rather
+        # than the caller having to unregister/re-register every time
+        '__oneshot',
+        '__registrations_changed',
         # We have to track the buffer separately to avoid freaking ctypes out
         # if resize is called more than once; only the originally allocated
         # object "owns" the memory, even after a call to resize. There is no way
@@ -76,44 +141,140 @@ class wsapoll:
     ]
 
     def __init__(self, sizehint=max(getallocationgranularity() // sizeof(WSAPOLLFD), 1)):
+        # Slots beyond len(impl) are never read -- _WSAPoll is always passed
+        # an explicit count -- so neither this allocation nor the later
+        # ctypes.resize growths need to zero the tail.
         buf = (WSAPOLLFD * sizehint)()
 
-        self._registered = {}
+        self.__fd_to_idx = {}
         self.__impl = (WSAPOLLFD * 0).from_buffer(buf)
-        self.__impl_uptodate = True
+        self.__n_maybe_affected = 0
+        self.__obj_to_fd = WeakKeyDictionary()
+        self.__oneshot = {}
+        self.__registrations_changed = False
         self.__buffer = buf
         self.__lock = Lock()
 
+    @property
+    def _registered(self):
+        # derived on demand (cold path only); the slots plus __fd_to_idx are
+        # the single source of truth, so register/unregister churn doesn't
+        # also create and destroy entries in a parallel dict
+        return {slot.fd: slot.events for slot in self.__impl}
+
     def __repr__(self):
         return f"<{__name__}.{self.__class__.__name__} _registrations={{{', '.join(f'{fd!r}: {repr_flags(eventmask, POLL_FLAGS_FOR_REPR)}' for fd, eventmask in self._registered.items())}}}>"
 
-    def __check_maybe_affected(self):
-        return any(
-            (
-                slot.fd >= 0
-                and slot.events == _POLL_DISCONNECTION
-            )
-            for slot in self.__impl
-        )
+    def _check(self):
+        impl = self.__impl
+        fd_to_idx = self.__fd_to_idx
+
+        # in any correct execution a slot/index desync surfaces as either a
+        # length mismatch or a duplicate fd, and this catches both in O(1)
+        # (a duplicated slot fd leaves fd_to_idx with fewer keys than slots)
+        assert len(impl) == len(fd_to_idx), (len(impl), len(fd_to_idx))
+
+        if _FULL_CHECK:
+            assert set(slot.fd for slot in impl) == set(fd_to_idx.keys())
+            assert all(impl[idx].fd == fd for fd, idx in fd_to_idx.items())
+
+    def __getfd(self, fileobj):
+        # a socket's fd never changes while it's open, so repeat calls with
+        # an object we've already resolved can skip getfd's fileno() virtual
+        # call; non-weakref-able arguments (e.g. plain int fds, for which
+        # getfd is trivial anyway) just take the uncached path
+        try:
+            return self.__obj_to_fd[fileobj]
+        except (KeyError, TypeError):
+            pass
+
+        fd_ = getfd(fileobj)
+
+        try:
+            self.__obj_to_fd[fileobj] = fd_
+        except TypeError:
+            pass
+
+        return fd_
 
     def poll(self, timeout=None):
+        out = []
+        self.__poll_into(out, timeout)
+        return out
+
+    def poll_into(self, out, timeout=None):
+        """like :meth:`poll`, but clear and refill the caller-provided list
+        *out* instead of allocating a fresh one; returns the event count.
+
+        Lets a tight event loop reuse one result list across iterations
+        rather than allocating (and garbage-collecting) a list per call.
+        """
+        out.clear()
+        self.__poll_into(out, timeout)
+        return len(out)
+
+    def __poll_into(self, out, timeout):
         with enter_or_die(self.__lock, "concurrent poll() invocation"):
-            if not self.__impl_uptodate:
-                self.__update_impl()
-
-                if IS_PRE_19041 and (timeout is None) and self.__check_maybe_affected():
+            if self.__registrations_changed:
+                if IS_PRE_19041 and (timeout is None) and self.__n_maybe_affected:
                     logging.warning("Outbound TCP connection failures won't be reported by wsapoll.poll() on versions of Windows prior to \"Windows 10 version 2004 (OS build 19041)\"; consider updating the operating system, using IOCP (via asyncio), or setting a finite timeout.\nFor more information, see https://daniel.haxx.se/blog/2012/10/10/wsapoll-is-broken/")
 
-            timeout_ms = uptruncate(timeout * 1000) if timeout is not None else -1
-            return self._poll(timeout_ms)
+                self.__registrations_changed = False
 
-    def _poll(self, timeout=-1):
+            if timeout is None:
+                timeout_ms = -1
+            elif timeout == 0:
+                # non-blocking probe; a common pattern on every loop
+                # iteration, so don't bother scaling
+                timeout_ms = 0
+            else:
+                timeout_ms = uptruncate(timeout * 1000)
+
+            self._poll(timeout_ms, out)
+
+            if self.__oneshot and out:
+                self.__disarm_oneshot(out)
+
+    def __disarm_oneshot(self, results):
+        impl = self.__impl
+        fd_to_idx = self.__fd_to_idx
+        oneshot = self.__oneshot
+
+        for fd, revents in results:
+            mask = oneshot.get(fd)
+            if mask:
+                slot = impl[fd_to_idx[fd]]
+                events = slot.events & ~(revents & mask)
+
+                if IS_PRE_19041:
+                    self.__n_maybe_affected += (events == _POLL_DISCONNECTION) - (slot.events == _POLL_DISCONNECTION)
+
+                slot.events = events
+
+                self.__registrations_changed = True
+
+    def _poll(
+        self, timeout=-1, out=None, *,
+        # every module-global this method touches, bound as a keyword-only
+        # default so the interpreter resolves it as a local (LOAD_FAST)
+        # instead of a module dict lookup -- this runs every event loop tick
+        _WSAPoll=_WSAPoll,
+        _WSAGetLastError=_WSAGetLastError,
+        _SOCKET_ERROR=SOCKET_ERROR,
+        _WSAEINTR=WSAEINTR,
+        _WSAPOLLFD_STRUCT=_WSAPOLLFD_STRUCT,
+        _monotonic_ns=monotonic_ns,
+    ):
         impl = self.__impl
         impl_len = len(impl)
 
+        if out is None:
+            out = []
+
         # https://github.com/python/cpython/blob/v3.13.0/Modules/selectmodule.c#L645-L647
-        if timeout >= 0:
-            timeout_deadline = monotonic_ns() // 1000 + timeout
+        # (a non-blocking timeout=0 probe needs no deadline: see below)
+        if timeout > 0:
+            deadline_ns = _monotonic_ns() + timeout * 1_000_000
 
         # https://github.com/python/cpython/blob/v3.13.0/Modules/selectmodule.c#L675-L701
         while True:
@@ -121,14 +282,19 @@ class wsapoll:
             ret = _WSAPoll(impl, impl_len, timeout)
 
             # https://learn.microsoft.com/en-us/windows/win32/api/winsock2/nf-winsock2-wsapoll#return-value
-            if ret == SOCKET_ERROR:
+            if ret == _SOCKET_ERROR:
                 errno = _WSAGetLastError()
 
                 # https://peps.python.org/pep-0475/
-                if errno == WSAEINTR:
+                if errno == _WSAEINTR:
+                    if timeout == 0:
+                        # retrying a non-blocking probe is pointless;
+                        # report "nothing ready", just like ret == 0 would
+                        return out
+
                     # https://github.com/python/cpython/blob/v3.13.0/Modules/selectmodule.c#L692-L699
-                    if timeout >= 0:
-                        timeout = max(timeout_deadline - monotonic_ns() // 1000, 0)
+                    if timeout > 0:
+                        timeout = max((deadline_ns - _monotonic_ns()) // 1_000_000, 0)
                     continue
 
                 raise WinError(errno)
@@ -136,90 +302,238 @@ class wsapoll:
             assert 0 <= ret <= impl_len
             break
 
-        return [
-            (fd, events)
-            for fd, events in ((slot.fd, slot.revents) for slot in impl)
-                if events
-        ]
-
-    def __update_impl(self):
-        registered = self._registered
+        # WSAPoll returns the count of slots with non-zero revents, so there
+        # is nothing to collect when it's 0 (the common timeout case), and we
+        # can stop scanning as soon as we've seen that many hits.
+        if ret == 0:
+            return out
+
+        mv = memoryview(self.__buffer).cast('B')
+        append = out.append
+        for fd, events, revents in _WSAPOLLFD_STRUCT.iter_unpack(mv[:impl_len * _WSAPOLLFD_STRUCT.size]):
+            if revents:
+                append((fd, revents))
+                ret -= 1
+                if not ret:
+                    break
+        return out
+
+    def __reserve(self, fds):
+        "grow the backing buffer, if necessary, to hold at least *fds* slots."
         impl = self.__impl
         buf = self.__buffer
 
+        needed = sizeof(impl._type_ * fds)
+        if needed <= sizeof(buf):
+            return
+
+        # ...But first, actually purchase moar RAM
+        new_size = max(sizeof(impl._type_ * (len(impl) * 2)), needed)
+        if new_size > _GROWTH_ALIGN_THRESHOLD:
+            new_size = smallest_multiple_atleast(getallocationgranularity(), new_size)
+
+        resize(buf, new_size)
+
+    def __update_impl(self, registered):
+        "rebuild the slots and index wholesale from an fd -> eventmask mapping."
+        buf = self.__buffer
+
         fds = len(registered)
-        impl_t = impl._type_ * fds
-
-        if sizeof(impl_t) > sizeof(buf):
-            # ...But first, actually purchase moar RAM
-            resize(
-                buf,
-                smallest_multiple_atleast(
-                    getallocationgranularity(),
-                    max(
-                        sizeof(impl._type_ * (len(impl) * 2)),
-                        sizeof(impl_t)
-                    )
-                )
-            )
+
+        self.__reserve(fds)
+        impl_t = self.__impl._type_ * fds
 
         self.__impl = impl = impl_t.from_buffer(buf)
+        self.__fd_to_idx = fd_to_idx = {}
+        self.__oneshot.clear()
 
-        for slot, (fd, eventmask) in zip(impl, registered.items()):
+        for idx, (slot, (fd, eventmask)) in enumerate(zip(impl, registered.items())):
             slot.fd = fd
             slot.events = eventmask
+            slot.revents = 0
+            fd_to_idx[fd] = idx
+
+        if IS_PRE_19041:
+            self.__n_maybe_affected = sum(1 for eventmask in registered.values() if eventmask == _POLL_DISCONNECTION)
+
+        self.__registrations_changed = True
+
+    def register(self, fd, eventmask=(POLLIN | POLLPRI | POLLOUT), oneshot=False):
+        fd_ = self.__getfd(fd)
+        with self.__lock:
+            idx = self.__fd_to_idx.get(fd_)
+
+            if idx is not None:
+                slot = self.__impl[idx]
+
+                if IS_PRE_19041:
+                    self.__n_maybe_affected += (eventmask == _POLL_DISCONNECTION) - (slot.events == _POLL_DISCONNECTION)
+
+                slot.events = eventmask
+            else:
+                idx = len(self.__impl)
+
+                self.__reserve(idx + 1)
+                impl_t = self.__impl._type_ * (idx + 1)
+
+                self.__impl = impl = impl_t.from_buffer(self.__buffer)
+
+                slot = impl[idx]
+                slot.fd = fd_
+                slot.events = eventmask
+                slot.revents = 0
+
+                self.__fd_to_idx[fd_] = idx
+
+                if IS_PRE_19041:
+                    self.__n_maybe_affected += (eventmask == _POLL_DISCONNECTION)
 
-        self.__impl_uptodate = True
+            if oneshot:
+                self.__oneshot[fd_] = eventmask
+            else:
+                self.__oneshot.pop(fd_, None)
 
-    def register(self, fd, eventmask=(POLLIN | POLLPRI | POLLOUT)):
-        fd_ = getfd(fd)
+            self.__registrations_changed = True
+
+            if _DEBUG_CHECK:
+                self._check()
+
+    def register_many(self, items, oneshot=False):
+        """register many ``(fd, eventmask)`` pairs at once.
+
+        Equivalent to calling :meth:`register` for each pair, except the
+        backing buffer is grown at most once, up front, instead of
+        potentially once per fd. *oneshot* applies to every pair in the
+        batch.
+        """
         with self.__lock:
-            self._registered[fd_] = eventmask
+            fd_to_idx = self.__fd_to_idx
+
+            new = {}
+            for fd, eventmask in items:
+                fd_ = self.__getfd(fd)
+                idx = fd_to_idx.get(fd_)
+
+                if idx is not None:
+                    slot = self.__impl[idx]
+
+                    if IS_PRE_19041:
+                        self.__n_maybe_affected += (eventmask == _POLL_DISCONNECTION) - (slot.events == _POLL_DISCONNECTION)
+
+                    slot.events = eventmask
+
+                    if oneshot:
+                        self.__oneshot[fd_] = eventmask
+                    else:
+                        self.__oneshot.pop(fd_, None)
+                else:
+                    new[fd_] = eventmask
+
+            base = len(self.__impl)
 
-            self.__impl_uptodate = False
+            self.__reserve(base + len(new))
+            impl_t = self.__impl._type_ * (base + len(new))
+
+            self.__impl = impl = impl_t.from_buffer(self.__buffer)
+
+            for idx, (fd_, eventmask) in enumerate(new.items(), base):
+                slot = impl[idx]
+                slot.fd = fd_
+                slot.events = eventmask
+                slot.revents = 0
+
+                fd_to_idx[fd_] = idx
+
+                if IS_PRE_19041:
+                    self.__n_maybe_affected += (eventmask == _POLL_DISCONNECTION)
+
+                if oneshot:
+                    self.__oneshot[fd_] = eventmask
+
+            self.__registrations_changed = True
+
+            if _DEBUG_CHECK:
+                self._check()
 
     def unregister(self, fd):
-        fd_ = getfd(fd)
+        fd_ = self.__getfd(fd)
         with self.__lock:
             # https://github.com/python/cpython/blob/v3.13.0/Modules/selectmodule.c#L593
-            del self._registered[fd_]
+            idx = self.__fd_to_idx.pop(fd_)
+            self.__oneshot.pop(fd_, None)
+
+            impl = self.__impl
+
+            if IS_PRE_19041:
+                self.__n_maybe_affected -= (impl[idx].events == _POLL_DISCONNECTION)
+
+            # slot order is irrelevant to WSAPoll, so instead of compacting
+            # the whole tail down a slot, swap the last slot into the hole:
+            # O(1) regardless of pollset size, and only one index to fix up.
+            last = len(impl) - 1
+            if idx != last:
+                memmove(
+                    byref(impl, idx * sizeof(WSAPOLLFD)),
+                    byref(impl, last * sizeof(WSAPOLLFD)),
+                    sizeof(WSAPOLLFD)
+                )
+                self.__fd_to_idx[impl[idx].fd] = idx
+
+            self.__impl = (impl._type_ * last).from_buffer(self.__buffer)
 
-            self.__impl_uptodate = False
+            self.__registrations_changed = True
 
-    def modify(self, fd, eventmask):
-        fd_ = getfd(fd)
+            if _DEBUG_CHECK:
+                self._check()
+
+    def modify(self, fd, eventmask, oneshot=False):
+        fd_ = self.__getfd(fd)
         with self.__lock:
-            if fd_ not in self._registered:
+            idx = self.__fd_to_idx.get(fd_)
+
+            if idx is None:
                 # https://github.com/python/cpython/blob/v3.13.0/Modules/selectmodule.c#L549
                 raise OSError(ENOENT, f"{fd!r} is not registered")
 
-            self._registered[fd_] = eventmask
+            slot = self.__impl[idx]
+
+            if IS_PRE_19041:
+                self.__n_maybe_affected += (eventmask == _POLL_DISCONNECTION) - (slot.events == _POLL_DISCONNECTION)
+
+            slot.events = eventmask
+
+            if oneshot:
+                self.__oneshot[fd_] = eventmask
+            else:
+                self.__oneshot.pop(fd_, None)
 
-            self.__impl_uptodate = False
+            self.__registrations_changed = True
+
+            if _DEBUG_CHECK:
+                self._check()
 
     def _clear(self):
         with self.__lock:
-            self._registered.clear()
-
-            self.__update_impl()
+            self.__update_impl({})
 
     def _selectors_close_impl(self):
         with self.__lock:
             # allow garbage-collection
-            del self._registered,\
+            del self.__fd_to_idx,\
                 self.__impl,\
+                self.__obj_to_fd,\
+                self.__oneshot,\
                 self.__buffer
 
-            self.__impl_uptodate = False
+            self.__registrations_changed = False
 
     def __getstate__(self):
         return self._registered
 
     def __setstate__(self, state):
         self.__init__(sizehint=len(state))
-        self._registered.update(state)
 
-        self.__update_impl()
+        self.__update_impl(state)
 
 
 # https://github.com/python/cpython/blob/v3.13.0/Lib/selectors.py#L412-L418
@@ -1,10 +1,10 @@
 from ctypes import Array as ctypes_Array
 from _ctypes import _CData
-from collections.abc import Mapping, MutableMapping
+from collections.abc import Iterable, Mapping, MutableMapping
 from numbers import Real
 from selectors import _PollLikeSelector
 from threading import Lock
-from typing import ClassVar, List, NamedTuple, Optional, Protocol, Tuple, TypeVar, Union
+from typing import ClassVar, Dict, List, NamedTuple, Optional, Protocol, Tuple, TypeVar, Union
 
 from ._util.wintypes_extra import WSAPOLLFD
 
@@ -31,25 +31,36 @@ class _Fileobj(Protocol):
     def fileno(self) -> int: ...
 
 class wsapoll:
-    __slots__ = ['__impl', '__fd_to_key', '__buffer']
-    _registered: MutableMapping[int, int]
+    __slots__ = ['__fd_to_idx', '__impl', '__n_maybe_affected', '__obj_to_fd', '__oneshot', '__registrations_changed', '__buffer']
+    __fd_to_idx: Dict[int, int]
     __impl: ctypes_Array[WSAPOLLFD]
-    __impl_uptodate: bool
+    __n_maybe_affected: int
+    __obj_to_fd: MutableMapping[_Fileobj, int]
+    __oneshot: Dict[int, int]
+    __registrations_changed: bool
     __buffer: _CData
     __lock: Lock
     def __init__(self, sizehint: int=...) -> None: ...
+    @property
+    def _registered(self) -> Mapping[int, int]: ...
     def __repr__(self) -> str: ...
 
-    def register(self, fd: Union[_Fileobj, int], eventmask: int=...) -> None: ...
-    def modify(self, fd: Union[_Fileobj, int], eventmask: int) -> None: ...
+    def register(self, fd: Union[_Fileobj, int], eventmask: int=..., oneshot: bool=False) -> None: ...
+    def register_many(self, items: Iterable[Tuple[Union[_Fileobj, int], int]], oneshot: bool=False) -> None: ...
+    def modify(self, fd: Union[_Fileobj, int], eventmask: int, oneshot: bool=False) -> None: ...
     def unregister(self, fd: Union[_Fileobj, int]) -> None: ...
     def poll(self, timeout: Optional[Real]=None) -> List[Tuple[int, int]]: ...
+    def poll_into(self, out: List[Tuple[int, int]], timeout: Optional[Real]=None) -> int: ...
 
-    def _poll(self, timeout: int=-1) -> List[Tuple[int, int]]: ...
+    def _check(self) -> None: ...
+    def _poll(self, timeout: int=-1, out: Optional[List[Tuple[int, int]]]=None) -> List[Tuple[int, int]]: ...
     def _clear(self) -> None: ...
-    def __check_maybe_affected(self) -> bool: ...
     def _selectors_close_impl(self) -> None: ...
-    def __update_impl(self) -> None: ...
+    def __getfd(self, fileobj: Union[_Fileobj, int]) -> int: ...
+    def __reserve(self, fds: int) -> None: ...
+    def __update_impl(self, registered: Mapping[int, int]) -> None: ...
+    def __poll_into(self, out: List[Tuple[int, int]], timeout: Optional[Real]) -> None: ...
+    def __disarm_oneshot(self, results: List[Tuple[int, int]]) -> None: ...
     def __getstate__(self) -> Mapping[int, int]: ...
     def __setstate__(self, state: Mapping[int, int]) -> None: ...
 